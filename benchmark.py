@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+"""Load test the command handlers with synthetic chat traffic against a stub upstream and a fixture SDE.
+
+    ./benchmark.py --target irc --rate 50 --count 2000 --concurrency 10
+
+Reports throughput, p50/p99 service time, queue wait and memory per command trigger. Nothing here talks to the
+real eve-central or EVE API servers or touches the databases in ./db.
+"""
+
+from __future__ import print_function
+from __future__ import division
+from collections import defaultdict
+import gc
+import imp
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import argh
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+bot_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(bot_path, 'plugins'))
+
+# typeID, typeName, marketGroupID, published
+fixture_types = [(34, 'Tritanium', 1857, 1), (35, 'Pyerite', 1857, 1), (36, 'Mexallon', 1857, 1),
+                 (37, 'Isogen', 1857, 1), (38, 'Nocxium', 1857, 1), (39, 'Zydrine', 1857, 1),
+                 (40, 'Megacyte', 1857, 1), (11399, 'Morphite', 1857, 1),
+                 (16272, 'Heavy Water', 1033, 1), (16273, 'Liquid Ozone', 1033, 1),
+                 (29668, '30 Day Pilot\'s License Extension (PLEX)', 1923, 1),
+                 (44992, 'PLEX', 1923, 1), (587, 'Rifter', 64, 1), (588, 'Reaper', None, 1),
+                 (691, 'Rifter Blueprint', 204, 1), (17478, 'Retriever', 494, 1)]
+fixture_systems = [(30000142, 'Jita'), (30002187, 'Amarr'), (30002659, 'Dodixie'),
+                   (30002053, 'Hek'), (30002510, 'Rens')]
+
+# (weight, message) pairs. Chatter that isn't a command is part of the load too.
+default_traffic = [(20, '.jita tritanium'), (10, '.jita plex'), (5, '.amarr heavy water'),
+                   (5, '.dodixie rifter'), (3, '.hek ite'), (3, '.rens megacyte'),
+                   (5, '.eve'), (2, '.sisi'), (5, '.time'), (5, '.ops'), (1, '.addop 0d1h30m BENCHMARK OP'),
+                   (2, '.help'), (30, 'o7 anyone up for a roam?')]
+
+
+def create_fixture_sde(path):
+    """Writes a tiny SDE with just the tables pricecheck_plugin reads."""
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE invTypes (typeID INTEGER PRIMARY KEY, typeName TEXT, "
+                       "marketGroupID INTEGER, published INTEGER)")
+    connection.execute("CREATE TABLE mapSolarSystems (solarSystemID INTEGER PRIMARY KEY, solarSystemName TEXT)")
+    connection.executemany("INSERT INTO invTypes VALUES (?, ?, ?, ?)", fixture_types)
+    connection.executemany("INSERT INTO mapSolarSystems VALUES (?, ?)", fixture_systems)
+    connection.commit()
+    connection.close()
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """Answers eve-central marketstat and EVE API ServerStatus requests with canned data."""
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        url = urlparse(self.path)
+        if url.path == '/api/marketstat/json':
+            type_ids = parse_qs(url.query).get('typeid', [])
+            body = json.dumps([self.marketstat(int(type_id)) for type_id in type_ids])
+            content_type = 'application/json'
+        elif url.path == '/server/ServerStatus.xml.aspx':
+            body = ("<?xml version='1.0' encoding='UTF-8'?><eveapi version=\"2\"><result>"
+                    "<serverOpen>True</serverOpen><onlinePlayers>31337</onlinePlayers>"
+                    "</result></eveapi>")
+            content_type = 'application/xml'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def marketstat(type_id):
+        price = type_id * 1.5
+        return {"all": {"forQuery": {"types": [type_id]}, "volume": type_id * 1000},
+                "buy": {"max": price * 0.95},
+                "sell": {"min": price}}
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_upstream(delay):
+    StubUpstreamHandler.delay = delay
+    server = StubUpstreamServer(('127.0.0.1', 0), StubUpstreamHandler)
+    thread = threading.Thread(target=server.serve_forever, name='stub-upstream')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def point_plugins_at_fixtures(fixture_path, upstream_url):
+    """Redirects plugin databases and upstream URLs before the plugins are initialized."""
+    import pricecheck_plugin
+    import eve_status_plugin
+    import timers_plugin
+    import towers_plugin
+    pricecheck_plugin.database_path = os.path.join(fixture_path, 'sqlite-latest.sqlite')
+    pricecheck_plugin.marketstat_url = upstream_url + '/api/marketstat/json'
+    for servername in eve_status_plugin.server_status_urls:
+        eve_status_plugin.server_status_urls[servername] = upstream_url + '/server/ServerStatus.xml.aspx'
+    timers_plugin.database_path = os.path.join(fixture_path, 'timers_plugin.sqlite')
+    towers_plugin.database_path = os.path.join(fixture_path, 'towers_plugin.sqlite')
+    create_fixture_sde(pricecheck_plugin.database_path)
+    return [pricecheck_plugin.marketstat_cache, eve_status_plugin.response_cache]
+
+
+def commandmap_handler():
+    """Dispatches straight through CommandMap, the way both bots do."""
+    from commandmap import CommandMap
+    commands = CommandMap()
+    commands.load_plugins()
+
+    def handle(message, user):
+        return commands.dispatch(message, user)
+    return handle, commands, None
+
+
+def irc_handler():
+    """Drives BotTooper.respond_to_commands with msg() captured instead of written to a transport."""
+    irc_bot = imp.load_source('irc_bot', os.path.join(bot_path, 'irc-bot.py'))
+
+    class FakeTransportBot(irc_bot.BotTooper):
+        def msg(self, user, message, length=None):
+            self.sent.append((user, message))
+
+    bot = FakeTransportBot('tooper')
+    bot.sent = []
+
+    def handle(message, user):
+        bot.respond_to_commands(message, '#fleet', user)
+    return handle, bot.commands, None
+
+
+def jabber_handler():
+    """Drives BotTooper.get_responses with a stand-in for a groupchat message stanza."""
+    jabber_bot = imp.load_source('jabber_bot', os.path.join(bot_path, 'jabber-bot.py'))
+    bot = jabber_bot.BotTooper('tooper@example.com/bench', 'password', 'fleet@conference.example.com', 'tooper')
+
+    def handle(message, user):
+        return bot.get_responses({'body': message, 'type': 'groupchat', 'mucnick': user,
+                                  'from': 'fleet@conference.example.com/' + user})
+    return handle, bot.commands, None
+
+
+class FakeJID(str):
+    """Just enough of sleekxmpp's JID for the bot's message handlers."""
+
+    @property
+    def bare(self):
+        return self.split('/', 1)[0]
+
+
+def jabber_outbox_handler():
+    """Feeds BotTooper.groupchat_message so commands go through the work queue, workers and Outbox.
+
+    send_message is captured instead of written to a stream. Each call waits until a bot worker
+    has run the message, so service time includes time spent in the bot's own work queue.
+    """
+    jabber_bot = imp.load_source('jabber_bot', os.path.join(bot_path, 'jabber-bot.py'))
+    room = 'fleet@conference.example.com'
+    sent = []
+
+    class FakeStreamBot(jabber_bot.BotTooper):
+        def send_message(self, **stanza):
+            sent.append(stanza)
+
+        def get_responses(self, msg):
+            # the flag lives on this worker thread and would otherwise still hold its last request's result
+            self.commands.throttle.reset()
+            try:
+                return super(FakeStreamBot, self).get_responses(msg)
+            except Exception:
+                msg['failed'] = True
+                raise
+            finally:
+                msg['dropped'] = self.commands.throttle.dropped()
+                msg['done'].set()
+
+    bot = FakeStreamBot('tooper@example.com/bench', 'password', room, 'tooper')
+
+    def handle(message, user):
+        msg = {'body': message, 'type': 'groupchat', 'mucnick': user, 'from': FakeJID(room + '/' + user),
+               'to': FakeJID('tooper@example.com/bench'), 'done': threading.Event()}
+        bot.groupchat_message(msg)
+        msg['done'].wait()
+        bot.commands.throttle.record(msg.get('dropped', False))
+        if msg.get('failed'):
+            raise RuntimeError("command failed in a bot worker")
+
+    def summary():
+        """Waits for the Outbox to drain, then describes the stanzas it sent."""
+        drain_start = time.time()
+        while bot.outbox.pending and time.time() - drain_start < 60:
+            time.sleep(0.05)
+        line_counts = [len(stanza['mbody'].strip('\n').split('\n')) for stanza in sent]
+        import metrics
+        return ["outbox: {} stanzas, {} lines, at most {} lines per stanza, {} lines dropped, drained {:.2f}s "
+                "after the last command".format(len(sent), sum(line_counts), max(line_counts or [0]),
+                                                metrics.outbox_dropped_lines.get(), time.time() - drain_start)]
+    return handle, bot.commands, summary
+
+
+handlers = {'commandmap': commandmap_handler, 'irc': irc_handler, 'jabber': jabber_handler,
+            'jabber-outbox': jabber_outbox_handler}
+
+
+class RecordingThrottle(object):
+    """Stands in for CommandMap.throttle and remembers, per thread, whether the last request was dropped.
+
+    With no throttle to wrap every request is allowed, so the benchmark measures the commands
+    themselves rather than how often the token buckets say no.
+    """
+
+    def __init__(self, throttle=None):
+        self.throttle = throttle
+        self.local = threading.local()
+
+    def allow(self, user, trigger):
+        allowed = self.throttle is None or self.throttle.allow(user, trigger)
+        self.local.dropped = not allowed
+        return allowed
+
+    def retry_after(self, user, trigger):
+        return self.throttle.retry_after(user, trigger) if self.throttle is not None else None
+
+    def reset(self):
+        self.local.dropped = False
+
+    def record(self, dropped):
+        """Records a decision made for this thread's request on another thread."""
+        self.local.dropped = dropped
+
+    def dropped(self):
+        return getattr(self.local, 'dropped', False)
+
+
+def trigger_of(message):
+    trigger = message.split(None, 1)[0]
+    return trigger if trigger.startswith('.') else '(chatter)'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def generate_traffic(traffic, count, users, seed):
+    """Returns count (user, message) pairs drawn from the weighted traffic mix."""
+    rng = random.Random(seed)
+    population = list(itertools.chain.from_iterable([message] * weight for weight, message in traffic))
+    return [('pilot{}'.format(rng.randrange(users)), rng.choice(population)) for _ in range(count)]
+
+
+def run_load(handle, messages, rate, concurrency, caches, cold, throttle):
+    """Feeds messages to handle() at rate per second across concurrency worker threads.
+
+    Service time runs from when a worker picks a message up until handle() returns. Queue wait
+    is the time before that since the message was due to arrive, which is how far behind the
+    worker pool has fallen. With rate=0 nothing is due before it is picked up, so wait is zero.
+    Requests the throttle dropped are only counted, so they don't flatter the timings.
+    """
+    work = Queue()
+    service_times = defaultdict(list)
+    waits = defaultdict(list)
+    errors = defaultdict(int)
+    throttled = defaultdict(int)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            due, (user, message) = item
+            if cold:
+                clear_caches(caches)
+            failed = False
+            throttle.reset()
+            picked_up = time.time()
+            try:
+                handle(message, user)
+            except Exception:
+                failed = True
+            finished = time.time()
+            with lock:
+                if throttle.dropped():
+                    throttled[trigger_of(message)] += 1
+                    continue
+                service_times[trigger_of(message)].append(finished - picked_up)
+                waits[trigger_of(message)].append(max(0.0, picked_up - due) if due is not None else 0.0)
+                if failed:
+                    errors[trigger_of(message)] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    start = time.time()
+    for i, message in enumerate(messages):
+        if rate:
+            due = start + i / rate
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            due = None
+        work.put((due, message))
+    for _ in workers:
+        work.put(None)
+    for thread in workers:
+        thread.join()
+    return time.time() - start, service_times, waits, errors, throttled
+
+
+def current_rss_kib():
+    """Returns this process's resident set size right now, read from /proc/self/statm."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def memory_probe():
+    """Returns (column label, probe) for the best memory measurement available, or (None, None)."""
+    if tracemalloc is not None:
+        return 'peak KiB', 'tracemalloc'
+    elif os.path.exists('/proc/self/statm'):
+        return 'rss +KiB', 'statm'
+    else:
+        return None, None
+
+
+def clear_caches(caches):
+    for cache in caches:
+        cache.clear()
+
+
+def measure_memory(handle, messages, caches):
+    """Returns KiB used while handling one of each message, run sequentially.
+
+    Every message is run once first so imports and other first-call costs aren't charged to
+    whichever command happens to trigger them. Caches are cleared before each measured call, so
+    the numbers cover the full uncached path. On Python 3 this is the tracemalloc peak. On
+    Python 2 it is how much the resident set grew across the call, which is coarser (whole
+    pages) but still moves per command.
+    """
+    label, probe = memory_probe()
+    if probe is None:
+        return {}
+    def handle_quietly(message, user):
+        try:
+            handle(message, user)
+        except Exception:
+            pass  # counted as an error by run_load
+
+    distinct_messages = sorted(set(message for user, message in messages))
+    for i, message in enumerate(distinct_messages):
+        handle_quietly(message, 'warmup{}'.format(i))
+
+    memory = {}
+    for i, message in enumerate(distinct_messages):
+        clear_caches(caches)
+        gc.collect()
+        if probe == 'tracemalloc':
+            tracemalloc.start()
+            handle_quietly(message, 'memory{}'.format(i))
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            used = peak / 1024
+        else:
+            # keep the collector from handing pages back mid-call and hiding the growth
+            gc.disable()
+            try:
+                before = current_rss_kib()
+                handle_quietly(message, 'memory{}'.format(i))
+                used = current_rss_kib() - before
+            finally:
+                gc.enable()
+        trigger = trigger_of(message)
+        memory[trigger] = max(memory.get(trigger, 0), used)
+    return memory
+
+
+def report(wall_time, service_times, waits, errors, throttled, memory):
+    """Prints one row per trigger. The memory column is left out if it couldn't be measured."""
+    memory_label = memory_probe()[0]
+    columns = ['trigger', 'calls', 'ops/s', 'p50 ms', 'p99 ms', 'wait p99']
+    if memory_label:
+        columns.append(memory_label)
+    columns.extend(['errors', 'throttled'])
+    print(' '.join(['{:<12}'.format(columns[0])] + ['{:>9}'.format(column) for column in columns[1:]]))
+
+    def row(name, service, wait, memory_kib, error_count, throttled_count):
+        service = sorted(service)
+        cells = ['{:<12}'.format(name), '{:>9}'.format(len(service)), '{:>9.1f}'.format(len(service) / wall_time),
+                 '{:>9.2f}'.format(percentile(service, 0.5) * 1000), '{:>9.2f}'.format(percentile(service, 0.99) * 1000),
+                 '{:>9.2f}'.format(percentile(sorted(wait), 0.99) * 1000)]
+        if memory_label:
+            cells.append('{:>9}'.format('') if memory_kib is None else '{:>9.1f}'.format(memory_kib))
+        cells.append('{:>9}'.format(error_count))
+        cells.append('{:>9}'.format(throttled_count))
+        print(' '.join(cells))
+
+    for trigger in sorted(set(service_times) | set(throttled)):
+        row(trigger, service_times.get(trigger, []), waits.get(trigger, []), memory.get(trigger, 0),
+            errors.get(trigger, 0), throttled.get(trigger, 0))
+    row('all', itertools.chain.from_iterable(service_times.values()), itertools.chain.from_iterable(waits.values()),
+        None, sum(errors.values()), sum(throttled.values()))
+
+
+@argh.arg('--target', choices=sorted(handlers))
+def main(target='commandmap', rate=0.0, count=1000, concurrency=10, users=200, upstream_delay_ms=50.0,
+         cold=False, throttle=False, seed=0, traffic_file=None):
+    """Run a load test. rate=0 sends as fast as the workers can take it.
+
+    Messages are spread across the given number of distinct chat users. The per-user throttle is
+    off unless throttle is set. With it on, dropped requests are reported in their own column.
+
+    cold clears the marketstat, server status and response memo caches before every
+    command so each pricecheck goes upstream. traffic_file is a JSON list of [weight, message] pairs
+    that replaces the built-in mix.
+    """
+    if traffic_file:
+        with open(traffic_file) as f:
+            traffic = json.load(f)
+    else:
+        traffic = default_traffic
+    fixture_path = tempfile.mkdtemp(prefix='bot-tooper-bench-')
+    upstream = start_stub_upstream(float(upstream_delay_ms) / 1000)
+    try:
+        caches = point_plugins_at_fixtures(fixture_path, 'http://127.0.0.1:{}'.format(upstream.server_address[1]))
+        handle, commands, summary = handlers[target]()
+        caches.append(commands.memo.responses)
+        commands.throttle = RecordingThrottle(commands.throttle if throttle else None)
+        messages = generate_traffic(traffic, int(count), int(users), seed)
+        memory = measure_memory(handle, messages, caches)
+        # start the timed run as cold as a freshly started bot
+        clear_caches(caches)
+        wall_time, service_times, waits, errors, throttled = run_load(handle, messages, float(rate),
+                                                                      int(concurrency), caches, cold,
+                                                                      commands.throttle)
+        print("target={} messages={} users={} rate={} concurrency={} upstream_delay={}ms cold={} throttle={}".format(
+            target, count, users, rate or 'max', concurrency, upstream_delay_ms, cold, throttle))
+        report(wall_time, service_times, waits, errors, throttled, memory)
+        if summary is not None:
+            for line in summary():
+                print(line)
+    finally:
+        upstream.shutdown()
+        shutil.rmtree(fixture_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -0,0 +1,113 @@
+"""Non-blocking, rotating, JSON log output shared by both bots.
+
+Log calls on the reactor and worker threads only put the record on a queue. A listener thread
+does the formatting and file writes, so a slow disk never delays a reply.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import atexit
+import json
+import logging
+import logging.handlers
+import threading
+import metrics
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+# Attributes callers may attach with extra={...} that are copied into every JSON record.
+structured_fields = ('trigger', 'latency', 'target', 'user')
+
+log_records_dropped = metrics.registry.register(metrics.Counter(
+    'bottooper_log_records_dropped_total', "Log records discarded because the log queue was full."))
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object."""
+
+    def format(self, record):
+        entry = OrderedDict()
+        entry['time'] = datetime.utcfromtimestamp(record.created).isoformat() + 'Z'
+        entry['level'] = record.levelname
+        entry['logger'] = record.name
+        entry['message'] = record.getMessage()
+        for field in structured_fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a QueueListener without formatting them.
+
+    Message arguments are merged later on the listener thread, so a record that no handler
+    cares about costs one queue put. Records are dropped rather than blocking if the queue fills.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            log_records_dropped.inc()
+
+
+class QueueListener(object):
+    """Drains a queue of records into handlers from a daemon thread."""
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.run, name='log-listener')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Writes out whatever is still queued, then stops the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+
+
+def setup_logging(file_name, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5, rotate_when=None,
+                  queue_size=10000):
+    """Sends all logging to file_name through a background thread and returns the listener.
+
+    The file rotates after max_bytes, or on the rotate_when schedule ('midnight', 'h', ...) if it is set,
+    keeping backup_count old files.
+    """
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(file_name, when=rotate_when,
+                                                                 backupCount=backup_count, utc=True)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    queue = Queue(maxsize=queue_size)
+    listener = QueueListener(queue, file_handler)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -4,16 +4,21 @@ import os
 from glob import glob
 import sys
 import logging
+import time
+import metrics
+from throttle import CommandThrottle, ResponseMemo, normalize_args
 
 logger = logging.getLogger('commandmap')
 
-Command = namedtuple('Command', ['func', 'arity'])
+Command = namedtuple('Command', ['func', 'arity', 'memoize', 'admin_only', 'throttle'])
 
 
 class CommandMap(object):
-    def __init__(self):
+    def __init__(self, throttle=None, memo=None):
         self.commands = {}
         self.excluded_plugins = []
+        self.throttle = throttle if throttle is not None else CommandThrottle()
+        self.memo = memo if memo is not None else ResponseMemo()
 
     @staticmethod
     def arity(func):
@@ -25,24 +30,86 @@ class CommandMap(object):
                 return len(thing)
         return sum(map(_len, getargspec(func)))
 
-    def map_command(self, trigger_string, function):
-        """Map a trigger string to a plugin function."""
-        tf = Command(function, self.arity(function))
+    def map_command(self, trigger_string, function, memoize=True, admin_only=False, throttle=True):
+        """Map a trigger string to a plugin function.
+
+        Pass memoize=False for commands that change state or whose reply must never be shared
+        between requests, even ones made in the same second. Commands mapped with admin_only=True
+        are ignored unless dispatched with admin=True and are left out of triggers(). Pass
+        throttle=False for cheap commands users legitimately run many times in a row, like
+        marking a list of towers.
+        """
+        tf = Command(self.instrument(trigger_string, function), self.arity(function), memoize, admin_only,
+                     throttle)
         if not self.commands.get(trigger_string):
             self.commands[trigger_string] = tf
         else:
-            logger.debug("Failure: {} is already defined.")
+            logger.debug("Failure: %s is already defined.", trigger_string)
+
+    @staticmethod
+    def instrument(trigger_string, function):
+        """Wrap a plugin function so each call is counted and timed under its trigger."""
+        def instrumented(*args):
+            metrics.command_executions.inc(trigger=trigger_string)
+            metrics.commands_in_flight.inc()
+            start = time.time()
+            try:
+                return function(*args)
+            except Exception:
+                metrics.command_errors.inc(trigger=trigger_string)
+                raise
+            finally:
+                latency = time.time() - start
+                metrics.commands_in_flight.dec()
+                metrics.command_latency.observe(latency, trigger=trigger_string)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("RAN %s in %.1fms", trigger_string, latency * 1000,
+                                 extra={'trigger': trigger_string, 'latency': latency})
+        return instrumented
 
     def get_command(self, trigger_string):
         """Fetch a Command tuple for a given trigger."""
         return self.commands.get(trigger_string)
 
+    def dispatch(self, message, user=None, admin=False):
+        """Run the command in a chat message on behalf of user and return its responses.
+
+        Returns None if the message isn't a command or is an admin command and admin is False.
+        If user has run this trigger too often recently they get a single "slow down" reply, and
+        further requests return None until the throttle lets them through again.
+        Identical requests from any user that arrive within the memo window share one response.
+        """
+        message = message.split(None, 1)
+        command = self.get_command(message[0]) if message else None
+        if not command or (command.admin_only and not admin):
+            return None
+        trigger = message[0]
+        metrics.command_calls.inc(trigger=trigger)
+        if command.throttle and not self.throttle.allow(user, trigger):
+            logger.debug("Throttled %s for %s", trigger, user, extra={'trigger': trigger, 'user': user})
+            metrics.commands_throttled.inc(trigger=trigger)
+            retry_after = self.throttle.retry_after(user, trigger)
+            if retry_after is None:
+                return None
+            return ["Slow down, try {} again in {:.0f}s.".format(trigger, max(1, retry_after))]
+        if len(message) > 1 and command.arity > 1:
+            args = message[1]
+            call = lambda: command.func(args)
+        else:
+            args = None
+            call = command.func
+        if not command.memoize:
+            return call()
+        responses, hit = self.memo.get_or_compute((trigger, normalize_args(args)), call)
+        metrics.record_cache_lookup('response_memo', hit)
+        return responses
+
     def load_plugins(self, exclude=('')):
         """Imports each file matching ./plugins/*_plugin.py and calls it's init_plugin() function, passing self."""
         plugin_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'plugins'))
         sys.path.append(plugin_path)
         plugin_files = glob(os.path.join(plugin_path, '*_plugin.py'))
-        logger.debug("Loading plugins from {}".format(plugin_path))
+        logger.debug("Loading plugins from %s", plugin_path)
         for plugin_file in plugin_files:
             path, name = os.path.split(plugin_file)
             name = name.split('.', 1)[0]
@@ -51,11 +118,11 @@ class CommandMap(object):
                 # TODO: confirm plugin has required attributes
                 try:
                     plugin.init_plugin(self)
-                    logger.debug("Initialized {}".format(name))
+                    logger.debug("Initialized %s", name)
                 except AttributeError as e:
-                    logger.debug("Failed to initialize {} because it does not define init_plugin()".format(name))
+                    logger.debug("Failed to initialize %s because it does not define init_plugin()", name)
             else:
-                logger.debug("Skipped {} because it is in the exclude list.".format(name))
+                logger.debug("Skipped %s because it is in the exclude list.", name)
 
     def triggers(self):
-        return self.commands.keys()
\ No newline at end of file
+        return [trigger for trigger, command in self.commands.items() if not command.admin_only]
\ No newline at end of file
@@ -5,9 +5,13 @@ from twisted.internet import reactor, protocol
 from twisted.words.protocols import irc
 import argh
 from commandmap import CommandMap
+from throttle import CommandThrottle
+import metrics
+import botlog
 import logging
 import sys
 import time
+from fnmatch import fnmatch
 
 # ensure python2 is using unicode
 if sys.version_info < (3, 0):
@@ -15,16 +19,17 @@ if sys.version_info < (3, 0):
     sys.setdefaultencoding('utf8')
 
 log_file_name = 'irc.log'
-logging.basicConfig(filename=log_file_name, level=logging.INFO)
 logger = logging.getLogger('irc.bot')
 
 
 class BotTooper(irc.IRCClient):
-    def __init__(self, nickname):
+    def __init__(self, nickname, admins=(), throttle=None):
         self.nickname = nickname
-        self.commands = CommandMap()
+        self.admins = admins
+        self.commands = CommandMap(throttle=throttle)
         self.commands.load_plugins(exclude=('towers_plugin', 'timers_plugin'))
         self.commands.map_command(".help", self.help)
+        self.commands.map_command(".stats", self.stats, memoize=False, admin_only=True)
 
     def signedOn(self):
         # called on connect
@@ -35,14 +40,17 @@ class BotTooper(irc.IRCClient):
             self.sendLine("OPER {} {}".format(self.factory.operuser, self.factory.operpass))
     
     def kickedFrom(self, channel, kicker, message):
-        logger.debug("Kicked from {} by {} because {}.".format(channel, kicker, message))
+        logger.debug("Kicked from %s by %s because %s.", channel, kicker, message)
         logger.debug("Waiting 10 seconds before rejoin.")
         time.sleep(10)
         self.join(self.factory.channel)
 
     def privmsg(self, user, channel, message):
-        logger.debug("RECV user={} channel={} message={}".format(repr(user), repr(channel), repr(message)))
-        reactor.callInThread(self.respond_to_commands, message, self.get_reply_target(channel, user.split('!', 1)[0]))
+        logger.debug("RECV user=%r channel=%r message=%r", user, channel, message,
+                     extra={'user': user, 'target': channel})
+        nick = user.split('!', 1)[0]
+        reactor.callInThread(self.respond_to_commands, message, self.get_reply_target(channel, nick), nick,
+                             self.is_admin(user))
 
     def get_reply_target(self, channel, user):
         if self.is_private_message(channel):
@@ -50,20 +58,18 @@ class BotTooper(irc.IRCClient):
         elif self.is_channel_message(channel):
             return channel
 
-    def respond_to_commands(self, message, reply_to):
+    def respond_to_commands(self, message, reply_to, user=None, admin=False):
         # TODO: "before_commands" callback for history ignore plugin?
-        message = message.split(None, 1)
-        command = self.commands.get_command(message[0])
-        if command:
-            if len(message) > 1 and command.arity > 1:
-                self.send_responses(command.func(message[1]), reply_to)
-            else:
-                self.send_responses(command.func(), reply_to)
+        self.send_responses(self.commands.dispatch(message, user, admin), reply_to)
+
+    def is_admin(self, prefix):
+        """Match the sender's full nick!user@host prefix, since a bare nick can be taken by anyone."""
+        return any(fnmatch(prefix.lower(), mask.lower()) for mask in self.admins)
 
     def send_responses(self, responses, reply_to):
         if responses:
             for line in responses:
-                logger.debug("SEND reply_to={} line={}".format(reply_to, line))
+                logger.debug("SEND reply_to=%s line=%s", reply_to, line, extra={'target': reply_to})
                 self.msg(reply_to, line)
 
     def is_private_message(self, channel):
@@ -75,16 +81,21 @@ class BotTooper(irc.IRCClient):
     def help(self):
         return ["Available commands: {}".format(', '.join(sorted(self.commands.triggers())))]
 
+    def stats(self):
+        return metrics.stats_messages()
+
 
 class BotTooperFactory(protocol.ClientFactory):
-    def __init__(self, channel, nickname, operuser=None, operpass=None):
+    def __init__(self, channel, nickname, operuser=None, operpass=None, admins=(), throttle=None):
         self.channel = channel
         self.nickname = nickname
+        self.admins = admins
+        self.throttle = throttle
         self.operuser = operuser
         self.operpass = operpass
 
     def buildProtocol(self, addr):
-        protokol = BotTooper(self.nickname)
+        protokol = BotTooper(self.nickname, self.admins, self.throttle)
         protokol.factory = self
         return protokol
 
@@ -97,11 +108,37 @@ class BotTooperFactory(protocol.ClientFactory):
         reactor.stop()
 
 
-def main(host, port, channel, nickname, operuser=None, operpass=None, verbose=False):
+def thread_pool_backlog():
+    """Returns the number of respond_to_commands calls waiting on the reactor's thread pool."""
+    pool = reactor.getThreadPool()
+    try:
+        return pool._team.statistics().backloggedWorkCount
+    except AttributeError:
+        # twisted < 15.5 queues work directly on the pool
+        return pool.q.qsize()
+
+
+def main(host, port, channel, nickname, operuser=None, operpass=None, verbose=False, metrics_port=None,
+         log_max_bytes=10 * 1024 * 1024, log_backups=5, log_rotate_when=None, admins='',
+         throttle_rate=0.2, throttle_burst=3):
+    """admins is a comma separated list of nick!user@host masks (* and ? wildcards allowed) whose
+    senders may run admin commands such as .stats, e.g. 'alice!*@alice.users.example.net'.
+
+    throttle_rate and throttle_burst set the per-user, per-command limit: a user may run a command
+    throttle_burst times in a row, then once every 1/throttle_rate seconds.
+    """
+    botlog.setup_logging(log_file_name, max_bytes=int(log_max_bytes), backup_count=int(log_backups),
+                         rotate_when=log_rotate_when)
     if verbose:
         logger.setLevel(logging.DEBUG)
+        logging.getLogger('commandmap').setLevel(logging.DEBUG)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    metrics.worker_queue_depth.set_function(thread_pool_backlog)
     logger.debug("Attempting to connect.")
-    reactor.connectTCP(host, int(port), BotTooperFactory(channel, nickname, operuser, operpass))
+    admins = tuple(filter(None, admins.split(',')))
+    throttle = CommandThrottle(float(throttle_rate), int(throttle_burst))
+    reactor.connectTCP(host, int(port), BotTooperFactory(channel, nickname, operuser, operpass, admins, throttle))
     reactor.run()
 
 if __name__ == "__main__":
@@ -5,12 +5,21 @@
 import os
 import sys
 import logging
+import threading
+import time
+from collections import OrderedDict
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 import sleekxmpp
 import argh
 from commandmap import CommandMap
+from throttle import CommandThrottle
+import metrics
+import botlog
 
 log_file_name = 'jabber.log'
-logging.basicConfig(filename=log_file_name, level=logging.INFO)
 logger = logging.getLogger('jabber_bot')
 
 # ensure python2 is using unicode
@@ -19,18 +28,102 @@ if sys.version_info < (3, 0):
     sys.setdefaultencoding('utf8')
 
 
+class Outbox(object):
+    """Batches outgoing lines per recipient and sends at most one stanza per recipient per interval.
+
+    Replies queued for the same MUC or user while it is waiting out its interval are joined into a
+    single multi-line stanza of at most max_lines lines; anything past that goes out next round.
+    A reply identical to the one queued just before it, as happens when several users ask the same
+    thing and share a memoized response, is only sent once.
+
+    Each recipient's backlog is capped at max_pending_lines. Past that the oldest replies are dropped,
+    since a price quoted several seconds late is worse than none. The newest reply is always kept.
+    """
+
+    def __init__(self, send, interval=0.5, max_lines=10, max_pending_lines=30):
+        self.send = send
+        self.interval = interval
+        self.max_lines = max_lines
+        self.max_pending_lines = max_pending_lines
+        self.pending = OrderedDict()
+        self.last_sent = {}
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.run, name='jabber-outbox')
+        thread.daemon = True
+        thread.start()
+
+    def put(self, mto, mfrom, mtype, lines):
+        with self.condition:
+            replies = self.pending.setdefault((mto, mfrom, mtype), [])
+            if not replies or replies[-1] != list(lines):
+                replies.append(list(lines))
+            queued = sum(len(reply) for reply in replies)
+            while queued > self.max_pending_lines and len(replies) > 1:
+                dropped = replies.pop(0)
+                queued -= len(dropped)
+                metrics.outbox_dropped_lines.inc(len(dropped))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                batches = self.wait_for_batches()
+            for (mto, mfrom, mtype), lines in batches:
+                if len(lines) > 1:
+                    body = "\n".join([""] + lines)
+                else:
+                    body = lines[0]
+                try:
+                    self.send(mto=mto, mfrom=mfrom, mbody=body, mtype=mtype)
+                except Exception as e:
+                    logger.warning("Failed to send to %s: %s", mto, e, extra={'target': mto})
+
+    def wait_for_batches(self):
+        """Blocks until at least one recipient has lines queued and is clear to send, then takes them."""
+        while True:
+            now = time.time()
+            # a recipient that has waited out its interval is no different from one never sent to
+            for key in [key for key, sent in self.last_sent.items() if now - sent >= self.interval]:
+                del self.last_sent[key]
+            ready = [key for key in self.pending if key not in self.last_sent]
+            if ready:
+                return [(key, self.take_lines(key, now)) for key in ready]
+            elif self.pending:
+                self.condition.wait(min(self.last_sent[key] + self.interval for key in self.pending) - now)
+            else:
+                self.condition.wait()
+
+    def take_lines(self, key, now):
+        """Removes up to max_lines lines queued for key, leaving the rest for its next turn."""
+        lines = [line for reply in self.pending.pop(key) for line in reply]
+        if len(lines) > self.max_lines:
+            self.pending[key] = [lines[self.max_lines:]]
+            lines = lines[:self.max_lines]
+        self.last_sent[key] = now
+        return lines
+
+
 class BotTooper(sleekxmpp.ClientXMPP):
 
-    def __init__(self, jid, password, room, nick):
+    def __init__(self, jid, password, room, nick, workers=4, send_interval=0.5, admins=(), throttle=None):
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
         self.room = room
         self.nick = nick
+        self.admins = admins
+        # Event handlers only queue work so plugin I/O never holds up the XMPP event thread.
         self.add_event_handler("session_start", self.session_start)
-        self.add_event_handler("groupchat_message", self.groupchat_message, threaded=True)
-        self.add_event_handler("message", self.direct_message, threaded=True)
-        self.commands = CommandMap()
+        self.add_event_handler("groupchat_message", self.groupchat_message)
+        self.add_event_handler("message", self.direct_message)
+        self.commands = CommandMap(throttle=throttle)
         self.commands.load_plugins()
         self.commands.map_command(".help", self.help)
+        self.commands.map_command(".stats", self.stats, memoize=False, admin_only=True)
+        self.work = Queue()
+        self.outbox = Outbox(self.send_message, send_interval)
+        for i in range(workers):
+            worker = threading.Thread(target=self.command_worker, name='jabber-worker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
 
     def session_start(self, event):
         """Process the session_start event."""
@@ -39,51 +132,64 @@ class BotTooper(sleekxmpp.ClientXMPP):
         self.plugin['xep_0045'].joinMUC(self.room, self.nick, wait=True)
 
     def direct_message(self, msg):
-        """Process incoming message stanzas from any user."""
+        """Queue incoming message stanzas from any user."""
         if msg['type'] in ('chat', 'normal'):
-            responses = self.get_responses(msg)
-            if responses:
-                if len(responses) > 1:
-                    responses = ["\n".join([""] + responses)]
-                for response in responses:
-                    self.send_message(mto=msg['from'], mfrom=msg['to'], mbody=response)
+            self.work.put((msg, msg['from'], None))
 
     def groupchat_message(self, msg):
-        """Process incoming message stanzas from any chat room."""
+        """Queue incoming message stanzas from any chat room."""
         # Infinite loops are bad. Don't reply to self.
         if msg['mucnick'] != self.nick and msg['type'] == 'groupchat':
-            responses = self.get_responses(msg)
-            if responses:
-                if len(responses) > 1:
-                    responses = ["\n".join([""] + responses)]
-                for response in responses:
-                    self.send_message(mto=msg['from'].bare, mfrom=msg['to'], mbody=response, mtype='groupchat')
+            self.work.put((msg, msg['from'].bare, 'groupchat'))
 
-    def get_responses(self, msg):
-        """Return a list of responses to initialized triggers if any. Return an empty list if not."""
-        message = msg["body"].split(None, 1)
-        command = self.commands.get_command(message[0])
-        if command:
+    def command_worker(self):
+        """Run queued commands one at a time and hand their responses to the outbox."""
+        while True:
+            msg, reply_to, mtype = self.work.get()
             try:
-                if len(message) > 1 and command.arity > 1:
-                    return command.func(message[1])
-                else:
-                    return command.func()
+                responses = self.get_responses(msg)
             except Exception as e:
-                logger.debug("Unhandled exception: {}".format(e))
-                self.disconnect()
-                sys.exit()
-        else:
-            return None
+                # A failing plugin only loses this one reply, not the connection.
+                logger.exception("Unhandled exception running %r: %s", msg['body'], e,
+                                 extra={'user': msg['from'], 'target': reply_to})
+                continue
+            if responses:
+                self.outbox.put(reply_to, msg['to'], mtype, responses)
+
+    def get_responses(self, msg):
+        """Return a list of responses to initialized triggers if any. Return None if not."""
+        return self.commands.dispatch(msg["body"], str(msg["from"]), self.is_admin(msg))
+
+    def is_admin(self, msg):
+        """Admin commands are only honoured in direct messages, where the sender's real JID is known."""
+        return msg['type'] in ('chat', 'normal') and msg['from'].bare in self.admins
 
     def help(self):
         return ["Available commands: {}".format(', '.join(sorted(self.commands.triggers())))]
 
+    def stats(self):
+        return metrics.stats_messages()
+
+
+def main(jid, password, room, nick, verbose=False, metrics_port=None, workers=4, send_interval=0.5,
+         log_max_bytes=10 * 1024 * 1024, log_backups=5, log_rotate_when=None, admins='',
+         throttle_rate=0.2, throttle_burst=3):
+    """admins is a comma separated list of bare JIDs allowed to run admin commands such as .stats.
 
-def main(jid, password, room, nick, verbose=False):
+    throttle_rate and throttle_burst set the per-user, per-command limit: a user may run a command
+    throttle_burst times in a row, then once every 1/throttle_rate seconds.
+    """
+    botlog.setup_logging(log_file_name, max_bytes=int(log_max_bytes), backup_count=int(log_backups),
+                         rotate_when=log_rotate_when)
     if verbose:
         logger.setLevel(logging.DEBUG)
-    xmpp = BotTooper(jid, password, room, nick)
+        logging.getLogger('commandmap').setLevel(logging.DEBUG)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    admins = tuple(filter(None, admins.split(',')))
+    throttle = CommandThrottle(float(throttle_rate), int(throttle_burst))
+    xmpp = BotTooper(jid, password, room, nick, int(workers), float(send_interval), admins, throttle)
+    metrics.worker_queue_depth.set_function(xmpp.work.qsize)
     xmpp.register_plugin('xep_0030')  # Service Discovery
     xmpp.register_plugin('xep_0045')  # Multi-User Chat
     xmpp.register_plugin('xep_0199')  # XMPP Ping
@@ -0,0 +1,263 @@
+"""In-process counters, gauges and histograms for the bot, exposed as Prometheus text and as chat replies."""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Sample = namedtuple('Sample', ['suffix', 'labels', 'value'])
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """Returns the label values as a tuple in labelnames order."""
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def labels_for(self, key):
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        with self.lock:
+            return [Sample('', self.labels_for(key), value) for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super(Gauge, self).__init__(name, help_text, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read the unlabelled value from function() at collection time instead of storing it."""
+        self.function = function
+
+    def get(self, **labels):
+        if self.function is not None:
+            return self.function()
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [Sample('', [], self.function())]
+            except Exception as e:
+                logger.debug("Gauge %s callback failed: %s", self.name, e)
+                return []
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = list(counts)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall clock time spent inside the with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        """Returns (count, sum) for the given labels."""
+        with self.lock:
+            counts, total, count = self.values.get(self.key(labels), (None, 0.0, 0))
+            return count, total
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                labels = self.labels_for(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append(Sample('_bucket', labels + [('le', repr(float(bound)))], bucket_count))
+                samples.append(Sample('_bucket', labels + [('le', '+Inf')], count))
+                samples.append(Sample('_sum', labels, total))
+                samples.append(Sample('_count', labels, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every registered metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for sample in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, sample.suffix, _format_labels(sample.labels),
+                                                _format_value(sample.value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+command_calls = registry.register(Counter(
+    'bottooper_command_calls_total', "Commands requested, including memo hits and throttled requests, by trigger.",
+    ['trigger']))
+command_executions = registry.register(Counter(
+    'bottooper_command_executions_total', "Commands whose plugin function actually ran, by trigger.", ['trigger']))
+command_errors = registry.register(Counter(
+    'bottooper_command_errors_total', "Commands that raised an exception, by trigger.", ['trigger']))
+command_latency = registry.register(Histogram(
+    'bottooper_command_latency_seconds', "Time spent running a command, by trigger.", ['trigger']))
+commands_throttled = registry.register(Counter(
+    'bottooper_commands_throttled_total', "Commands dropped by the per-user throttle, by trigger.", ['trigger']))
+commands_in_flight = registry.register(Gauge(
+    'bottooper_commands_in_flight', "Commands currently running."))
+worker_queue_depth = registry.register(Gauge(
+    'bottooper_worker_queue_depth', "Work items waiting for a free worker thread."))
+outbox_dropped_lines = registry.register(Counter(
+    'bottooper_outbox_dropped_lines_total', "Reply lines discarded because a recipient's outbox backlog was full."))
+cache_requests = registry.register(Counter(
+    'bottooper_cache_requests_total', "Cache lookups, by cache and result (hit or miss).", ['cache', 'result']))
+upstream_latency = registry.register(Histogram(
+    'bottooper_upstream_request_latency_seconds', "Time spent waiting on upstream HTTP APIs.", ['host']))
+upstream_errors = registry.register(Counter(
+    'bottooper_upstream_errors_total', "Failed upstream HTTP requests, by host.", ['host']))
+sqlite_query_latency = registry.register(Histogram(
+    'bottooper_sqlite_query_latency_seconds', "Time spent running SQLite queries, by database.", ['database']))
+
+
+def record_cache_lookup(cache_name, hit):
+    cache_requests.inc(cache=cache_name, result='hit' if hit else 'miss')
+
+
+def stats_messages():
+    """Returns a short human readable summary of the collected metrics for the .stats command."""
+    messages = []
+    command_stats = []
+    for sample in command_calls.samples():
+        trigger = dict(sample.labels)['trigger']
+        count, total = command_latency.get(trigger=trigger)
+        mean_ms = (total / count * 1000) if count else 0.0
+        command_stats.append("{} x{} ({} ran, {:.0f}ms avg, {} err)".format(
+            trigger, sample.value, command_executions.get(trigger=trigger), mean_ms,
+            command_errors.get(trigger=trigger)))
+    messages.append("Commands: {}".format(', '.join(command_stats) if command_stats else "none yet"))
+
+    cache_stats = []
+    for cache_name in sorted(set(dict(sample.labels)['cache'] for sample in cache_requests.samples())):
+        hits = cache_requests.get(cache=cache_name, result='hit')
+        misses = cache_requests.get(cache=cache_name, result='miss')
+        cache_stats.append("{} {:.0%} of {}".format(cache_name, float(hits) / (hits + misses), hits + misses))
+    messages.append("Cache hit rate: {}".format(', '.join(cache_stats) if cache_stats else "no lookups yet"))
+
+    upstream_stats = []
+    for sample in upstream_latency.samples():
+        if sample.suffix == '_count':
+            host = dict(sample.labels)['host']
+            count, total = upstream_latency.get(host=host)
+            upstream_stats.append("{} {:.0f}ms avg, {} err of {}".format(
+                host, total / count * 1000, upstream_errors.get(host=host), count))
+    messages.append("Upstream: {}".format(', '.join(upstream_stats) if upstream_stats else "no requests yet"))
+
+    messages.append("In flight: {}  Queued: {}".format(commands_in_flight.get(), worker_queue_depth.get()))
+    return messages
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, host='127.0.0.1'):
+    """Serves /metrics on host:port from a daemon thread and returns the server."""
+    server = HTTPServer((host, int(port)), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logger.debug("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
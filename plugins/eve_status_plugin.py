@@ -4,7 +4,11 @@ import requests
 from expiringdict import ExpiringDict
 from lxml import etree
 from collections import namedtuple
+import time
+import metrics
 
+server_status_urls = {'tranquility': 'https://api.eveonline.com/server/ServerStatus.xml.aspx',
+                      'singularity': 'https://api.testeveonline.com/server/ServerStatus.xml.aspx'}
 response_cache = ExpiringDict(max_len=100, max_age_seconds=180)
 EveStatus = namedtuple('EveStatus', ['online', 'player_count'])
 
@@ -37,10 +41,8 @@ def get_singularity_status_message():
 
 
 def get_status(servername):
-    if servername == 'tranquility':
-        response = get_api_response('https://api.eveonline.com/server/ServerStatus.xml.aspx')
-    elif servername == 'singularity':
-        response = get_api_response('https://api.testeveonline.com/server/ServerStatus.xml.aspx')
+    if servername in server_status_urls:
+        response = get_api_response(server_status_urls[servername])
     else:
         raise ValueError("Servername should be in ['tranquility', 'singularity'] but was: {}".format(servername))
     if response:
@@ -52,12 +54,21 @@ def get_status(servername):
 
 def get_api_response(url):
     response = response_cache.get(url)
+    metrics.record_cache_lookup('response_cache', response is not None)
     if response:
         return response
     else:
-        response = requests.get(url)
+        start = time.time()
+        try:
+            response = requests.get(url)
+        except IOError:
+            metrics.upstream_errors.inc(host='eve-api')
+            raise
+        finally:
+            metrics.upstream_latency.observe(time.time() - start, host='eve-api')
         if response.status_code == 200:
             response_cache[url] = response
             return response
         else:
+            metrics.upstream_errors.inc(host='eve-api')
             return None
@@ -8,9 +8,12 @@ import json
 from expiringdict import ExpiringDict
 import os
 import logging
+import time
+import metrics
 
 database_path = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), os.pardir),
                                              'db', 'sqlite-latest.sqlite'))
+marketstat_url = 'http://api.eve-central.com/api/marketstat/json'
 marketstat_cache = ExpiringDict(max_len=100, max_age_seconds=1800)
 
 
@@ -66,29 +69,35 @@ def get_marketstat_json(system_id, type_ids):
             logging.debug("URL too long.")
             return None
         response = marketstat_cache.get(request_url)
+        metrics.record_cache_lookup('marketstat_cache', response is not None)
         if response is not None:
             return json.loads(response)
         else:
+            start = time.time()
             try:
                 response = requests.get(request_url, headers={'User-agent': 'Mozilla/5.0'},
                                         allow_redirects=True, verify=False)
                 if response.status_code == 200:
                     marketstat_cache[request_url] = response.content
                     return json.loads(response.content)
-                elif response.status_code == 400:
+                else:
+                    metrics.upstream_errors.inc(host='eve-central')
                     return None
             except IOError:
+                metrics.upstream_errors.inc(host='eve-central')
                 logging.debug("Problem encountered with HTTP request.")
                 return None
             except ValueError:
                 logging.debug("Problem encountered decoding JSON response.")
                 return None
+            finally:
+                metrics.upstream_latency.observe(time.time() - start, host='eve-central')
     else:
         return None
 
 
 def get_marketstat_request_url(system_id, type_ids):
-    url = ['http://api.eve-central.com/api/marketstat/json?typeid={}'.format(str(type_ids[0]))]
+    url = ['{}?typeid={}'.format(marketstat_url, str(type_ids[0]))]
     if len(type_ids) > 1:
         for typeid in type_ids[1:]:
             url.append('&typeid={}'.format(typeid))
@@ -125,11 +134,11 @@ def get_type_ids(item_name):
                        "AND marketGroupID NOT NULL " \
                        "AND published = 1"
         # try to find an exact match first
-        result = get_cursor().execute(query_string, (item_name,)).fetchall()
+        result = execute(query_string, (item_name,))
         if result:
             return [row[0] for row in result]
         # otherwise return partial matches
-        result = get_cursor().execute(query_string, ("%" + item_name + "%",)).fetchall()
+        result = execute(query_string, ("%" + item_name + "%",))
         return [row[0] for row in result]
     else:
         return []
@@ -140,7 +149,7 @@ def get_type_names(*type_ids):
                    "FROM invTypes " \
                    "WHERE typeId IN {}".format(_wildcards(type_ids))
 
-    return {row[0]: row[1] for row in get_cursor().execute(query_string, type_ids)}
+    return {row[0]: row[1] for row in execute(query_string, type_ids)}
 
 
 def get_solar_system_id(solar_system_name):
@@ -149,8 +158,8 @@ def get_solar_system_id(solar_system_name):
                        "FROM mapSolarSystems " \
                        "WHERE solarSystemName LIKE ? "
         try:
-            return get_cursor().execute(query_string, (solar_system_name,)).fetchone()[0]
-        except TypeError:
+            return execute(query_string, (solar_system_name,))[0][0]
+        except IndexError:
             return None
     else:
         return None
@@ -161,5 +170,11 @@ def get_cursor():
     return sqlite3.connect(database_path).cursor()
 
 
+def execute(query_string, parameters=()):
+    """Runs a query against the SDE and returns all rows, recording how long it took."""
+    with metrics.sqlite_query_latency.time(database='sde'):
+        return get_cursor().execute(query_string, parameters).fetchall()
+
+
 def _wildcards(args):
     return '({})'.format(','.join(['?']*len(args)))
@@ -3,8 +3,8 @@
 from datetime import datetime
 
 def init_plugin(command_map):
-    command_map.map_command(".time", utc_time)
-    command_map.map_command(".upladtime", uplad_time)
+    command_map.map_command(".time", utc_time, memoize=False)
+    command_map.map_command(".upladtime", uplad_time, memoize=False)
 
 
 def utc_time():
@@ -7,9 +7,10 @@ from datetime import datetime, timedelta
 import re
 import pony.orm
 import os
+import metrics
 
 database_path = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), os.pardir), 'db', 'timers_plugin.sqlite'))
-db = pony.orm.Database("sqlite", database_path, create_db=True)
+db = pony.orm.Database()
 
 # .addop <year-month-day@hour:minute> <name>
 datetime_args_pattern = re.compile(
@@ -29,12 +30,14 @@ class Event(db.Entity):
 
 
 def init_plugin(trigger_map, database=db):
+    # Bind at init time so database_path can be pointed elsewhere before the plugin loads.
+    database.bind("sqlite", database_path, create_db=True)
     # Map models to tables and create tables if they don't exist.
     database.generate_mapping(create_tables=True)
     pony.orm.sql_debug(False)
-    trigger_map.map_command(".ops", get_countdown_messages)
-    trigger_map.map_command(".addop", add_op)
-    trigger_map.map_command(".rmop", remove_event)
+    trigger_map.map_command(".ops", get_countdown_messages, memoize=False)
+    trigger_map.map_command(".addop", add_op, memoize=False, throttle=False)
+    trigger_map.map_command(".rmop", remove_event, memoize=False, throttle=False)
 
 
 def add_op(args=None):
@@ -77,13 +80,13 @@ def add_by_datetime(match):
 
 def add_event(date_time, event_name):
     event_name = upper_preserving_urls(event_name)
-    with pony.orm.db_session:
+    with metrics.sqlite_query_latency.time(database='timers'), pony.orm.db_session:
         Event(date_time=date_time, name=event_name)
 
 
 def remove_event(event_id_to_remove=None):
     if event_id_to_remove:
-        with pony.orm.db_session:
+        with metrics.sqlite_query_latency.time(database='timers'), pony.orm.db_session:
             event = Event.get(event_id=event_id_to_remove)
             if event is not None:
                 removed_name = event.name
@@ -106,7 +109,7 @@ def get_countdown_messages():
     Returns a list of messages reporting the time remaining or elapsed relative to each event in the event list.
     Events which have been expired for longer than 30 minutes will be removed from the list on the next .ops call.
     """
-    with pony.orm.db_session:
+    with metrics.sqlite_query_latency.time(database='timers'), pony.orm.db_session:
         events = Event.select().order_by(Event.date_time)
         messages = []
         if len(events) > 0:
@@ -5,19 +5,22 @@ Commands to retrieve the last datetime that towers were checked for a siphon.
 import pony.orm
 import datetime
 import os
+import metrics
 
 database_path = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), os.pardir), 'db', 'towers_plugin.sqlite'))
-db = pony.orm.Database("sqlite", database_path, create_db=True)
+db = pony.orm.Database()
 
 
 def init_plugin(trigger_map, database=db):
+    # Bound here instead of at import so callers can override database_path first
+    database.bind("sqlite", database_path, create_db=True)
     # Maps model classes to tables and creates tables if they don't exist
     database.generate_mapping(create_tables=True)
     pony.orm.sql_debug(False)
-    trigger_map.map_command(".addtower", add_tower)
-    trigger_map.map_command(".rmtower", remove_tower)
-    trigger_map.map_command(".towers", get_tower_messages)
-    trigger_map.map_command(".marktower", mark_checked)
+    trigger_map.map_command(".addtower", add_tower, memoize=False, throttle=False)
+    trigger_map.map_command(".rmtower", remove_tower, memoize=False, throttle=False)
+    trigger_map.map_command(".towers", get_tower_messages, memoize=False)
+    trigger_map.map_command(".marktower", mark_checked, memoize=False, throttle=False)
 
 
 class Tower(db.Entity):
@@ -35,7 +38,7 @@ def add_tower(tower_name=None):
     """
     if tower_name:
         tower_name = tower_name.upper().strip()
-        with pony.orm.db_session:
+        with metrics.sqlite_query_latency.time(database='towers'), pony.orm.db_session:
             if not Tower.get(name=tower_name):
                 Tower(name=tower_name)
                 return ['Tower added.']
@@ -52,7 +55,7 @@ def remove_tower(tower_id_to_remove=None):
     """
     usage_hint = ["Usage: .rmtower <tower_id>"]
     if tower_id_to_remove:
-        with pony.orm.db_session:
+        with metrics.sqlite_query_latency.time(database='towers'), pony.orm.db_session:
             try:
                 tower = Tower.get(id=tower_id_to_remove)
             except ValueError:
@@ -76,7 +79,7 @@ def mark_checked(tower_id_to_check=None):
     """
     usage_hint = ["Usage: .marktower <tower_id>"]
     if tower_id_to_check:
-        with pony.orm.db_session:
+        with metrics.sqlite_query_latency.time(database='towers'), pony.orm.db_session:
             try:
                 tower = Tower.get(id=tower_id_to_check)
             except ValueError:
@@ -98,7 +101,7 @@ def get_tower_messages():
     Returns a list of strings.
     """
     reply_messages = []
-    with pony.orm.db_session:
+    with metrics.sqlite_query_latency.time(database='towers'), pony.orm.db_session:
         towers = Tower.select().order_by(Tower.last_siphon_check)
         if len(towers) > 0:
             for tower in towers:
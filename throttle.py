@@ -0,0 +1,123 @@
+"""Per-user command rate limiting and short-lived response sharing for CommandMap.dispatch()."""
+
+import threading
+import time
+from expiringdict import ExpiringDict
+
+_missing = object()
+
+
+class TokenBucket(object):
+    """Holds up to capacity tokens, refilled continuously at rate tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.warned = False
+
+    def consume(self, tokens=1):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            self.warned = False
+            return True
+        else:
+            return False
+
+    def seconds_until(self, tokens=1):
+        """Returns how long until tokens will be available, assuming nothing else is consumed."""
+        return max(0.0, (tokens - self.tokens) / self.rate) if self.rate > 0 else float('inf')
+
+
+class CommandThrottle(object):
+    """Token buckets keyed on (user, trigger) so one user can't flood a single command.
+
+    A bucket left idle long enough to refill completely is indistinguishable from a new one,
+    so buckets are kept in an ExpiringDict and allowed to age out.
+    """
+
+    def __init__(self, rate=0.2, capacity=3, max_users=1000):
+        self.rate = rate
+        self.capacity = capacity
+        idle_seconds = max(1, int(capacity / rate)) if rate > 0 else 3600
+        self.buckets = ExpiringDict(max_len=max_users, max_age_seconds=idle_seconds)
+        self.lock = threading.Lock()
+
+    def allow(self, user, trigger):
+        """Returns True and spends a token if user may run trigger now."""
+        key = (user, trigger)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+            allowed = bucket.consume()
+            self.buckets[key] = bucket
+            return allowed
+
+    def retry_after(self, user, trigger):
+        """Returns seconds until user may run trigger again, or None if they were already told.
+
+        Only the first refusal in a row gets a number, so a user who keeps spamming gets one
+        notice rather than a reply to every dropped request.
+        """
+        with self.lock:
+            bucket = self.buckets.get((user, trigger))
+            if bucket is None or bucket.warned:
+                return None
+            bucket.warned = True
+            return bucket.seconds_until()
+
+
+class ResponseMemo(object):
+    """Shares one computed response between identical requests that arrive within max_age_seconds.
+
+    Requests that arrive while the first one is still running wait for its result instead of
+    starting their own.
+    """
+
+    def __init__(self, max_age_seconds=2, max_len=200):
+        self.responses = ExpiringDict(max_len=max_len, max_age_seconds=max_age_seconds)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """Returns (response, hit) where hit is True if compute() was not called for this request."""
+        with self.lock:
+            response = self.responses.get(key, _missing)
+            if response is not _missing:
+                return response, True
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            pending.wait()
+            response = self.responses.get(key, _missing)
+            if response is not _missing:
+                return response, True
+            # the first request failed or its result already expired, so do the work here
+            return compute(), False
+        try:
+            response = compute()
+            self.responses[key] = response
+            return response, False
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.set()
+
+
+def normalize_args(args):
+    """Collapses whitespace so '.jita  PLEX' and '.jita PLEX' share a response.
+
+    Case is kept because replies may echo the arguments back to whoever asked.
+    """
+    if args is None:
+        return None
+    return ' '.join(args.split())